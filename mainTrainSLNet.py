@@ -152,22 +152,22 @@ valid_sampler = SubsetRandomSampler(val_indices)
 data_loaders = \
     {'train' : \
             data.DataLoader(dataset, batch_size=args.batch_size, 
-                                sampler=train_sampler, pin_memory=False, num_workers=n_threads), \
+                                sampler=train_sampler, pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0), \
     'val'   : \
             data.DataLoader(dataset, batch_size=args.batch_size,
-                                    sampler=valid_sampler, pin_memory=False, num_workers=n_threads), \
+                                    sampler=valid_sampler, pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0), \
     'test'  : \
-            data.DataLoader(dataset_test, batch_size=1, pin_memory=False, num_workers=n_threads, shuffle=True)
+            data.DataLoader(dataset_test, batch_size=1, pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0, shuffle=True)
     }
 
 # Eval samples
 data_loaders_save = \
     {'train' : \
             data.DataLoader(dataset, batch_size=1, 
-                                sampler=SequentialSampler(list(range(dataset_size))), pin_memory=False, num_workers=n_threads), \
+                                sampler=SequentialSampler(list(range(dataset_size))), pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0), \
     'test'  : \
             data.DataLoader(dataset_test, batch_size=1, 
-                                sampler=SequentialSampler(list(range(len(dataset_test)))), pin_memory=False, num_workers=n_threads, shuffle=False)
+                                sampler=SequentialSampler(list(range(len(dataset_test)))), pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0, shuffle=False)
     }
 
 
@@ -256,7 +256,7 @@ for epoch in range(start_epoch, args.max_epochs):
 
         # Training
         for ix,(curr_img_stack, _) in enumerate(tqdm(curr_loader, desc='Optimizing images')):
-            curr_img_stack = curr_img_stack.to(device)
+            curr_img_stack = curr_img_stack.to(device, non_blocking=True)
             # Apply noise if needed, and only in the test set, as the train set comes from real images
             if args.add_noise==1 and curr_train_stage!='test':
                 curr_max = curr_img_stack.max()
@@ -445,7 +445,7 @@ for epoch in range(start_epoch, args.max_epochs):
                     curr_loader = data_loaders_save[curr_train_stage]
                     output_sparse_images = torch.zeros_like(curr_img_stack[0,0,...].unsqueeze(0).unsqueeze(0), device='cpu').repeat(len(curr_loader),1,1,1)
                     for ix,(curr_img_stack, _) in enumerate(curr_loader):      
-                        curr_img_stack = curr_img_stack.to(device)      
+                        curr_img_stack = curr_img_stack.to(device, non_blocking=True)      
                         with autocast():
                             # Predict dense part with the network
                             dense_part = F.relu(net(curr_img_stack))
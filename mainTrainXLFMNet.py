@@ -152,12 +152,12 @@ valid_sampler = SubsetRandomSampler(val_indices)
 data_loaders = \
     {'train' : \
             data.DataLoader(dataset, batch_size=args.batch_size, 
-                                sampler=train_sampler, pin_memory=False, num_workers=n_threads), \
+                                sampler=train_sampler, pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0), \
     'val'   : \
             data.DataLoader(dataset, batch_size=args.batch_size,
-                                    sampler=valid_sampler, pin_memory=False, num_workers=n_threads), \
+                                    sampler=valid_sampler, pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0), \
     'test'  : \
-            data.DataLoader(dataset_test, batch_size=1, pin_memory=False, num_workers=n_threads, shuffle=True)
+            data.DataLoader(dataset_test, batch_size=1, pin_memory=True, num_workers=n_threads, persistent_workers=n_threads>0, shuffle=True)
     }
 
 def init_weights(m):
@@ -300,10 +300,10 @@ for epoch in range(start_epoch, args.max_epochs):
         for ix,(curr_img_stack, local_volumes) in enumerate(curr_loader):
 
             # If empty or nan in volumes, don't use these for training 
-            if curr_img_stack.float().sum()==0 or torch.isnan(curr_img_stack.float().max()):
+            if not (curr_img_stack!=0).any() or torch.isnan(curr_img_stack).any():
                 continue
             # Normalize volumes if ill posed
-            if local_volumes.float().max()>=20000:
+            if (local_volumes>=20000).any():
                 local_volumes = local_volumes.float()
                 local_volumes = local_volumes / local_volumes.max() * 4500.0
                 local_volumes = local_volumes.half()
@@ -311,11 +311,11 @@ for epoch in range(start_epoch, args.max_epochs):
             # curr_img_stack returns both the dense and the sparse images, here we only need the sparse.
             if net.tempConv is None:
                 assert len(curr_img_stack.shape)>=5, "If sparse is used curr_img_stack should contain both images, dense and sparse stacked in the last dim."
-                curr_img_sparse = curr_img_stack[...,-1].clone().to(device) 
-                curr_img_stack = curr_img_stack[...,-1].clone().to(device)
+                curr_img_sparse = curr_img_stack[...,-1].to(device, non_blocking=True) 
+                curr_img_stack = curr_img_stack[...,-1].to(device, non_blocking=True)
             else:
-                curr_img_sparse = curr_img_stack[...,-1].clone().to(device)
-                curr_img_stack = curr_img_stack[...,0].clone().to(device)
+                curr_img_sparse = curr_img_stack[...,-1].to(device, non_blocking=True)
+                curr_img_stack = curr_img_stack[...,0].to(device, non_blocking=True)
             
             curr_img_stack = curr_img_stack.half()
 
@@ -331,7 +331,7 @@ for epoch in range(start_epoch, args.max_epochs):
                 curr_img_stack = pytorch_shot_noise.add_camera_noise(curr_img_stack)
                 curr_img_stack = curr_img_stack.float().to(device)
 
-            local_volumes = local_volumes.half().to(device)
+            local_volumes = local_volumes.half().to(device, non_blocking=True)
 
             # if conversion to half precission messed up the volumes, continue
             if torch.isinf(local_volumes.max()):
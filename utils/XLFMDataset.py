@@ -1,32 +1,218 @@
 from json import load
+import os
+import hashlib
 import torch
+import torch.multiprocessing
 from torch.utils import data
 import torch.nn.functional as F
-import csv
 import glob
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from torchvision.transforms import ToTensor
 import numpy as np
-from tifffile import imread
+from tifffile import imread, memmap
 from tqdm import tqdm
-import multipagetiff as mtif
 
 import utils.pytorch_shot_noise as pytorch_shot_noise
 from utils.misc_utils import *
 
 def get_lenslet_centers(filename):
-    x,y = [], []
-    with open(filename,'r') as f:
-        reader = csv.reader(f,delimiter='\t')
-        for row in reader:
-            x.append(int(row[0]))
-            y.append(int(row[1]))
-    lenslet_coords = torch.cat((torch.IntTensor(x).unsqueeze(1),torch.IntTensor(y).unsqueeze(1)),1)
-    return lenslet_coords
+    lenslet_coords = np.loadtxt(filename, dtype=np.int32, delimiter='\t', usecols=(0,1), ndmin=2)
+    return torch.from_numpy(lenslet_coords)
+
+# Output datatypes of read_tiff_stack, torch datatypes are mapped to their numpy equivalent
+torch_to_numpy_datatypes = {torch.float16: np.float16, torch.float32: np.float32, torch.float64: np.float64,
+    torch.uint8: np.uint8, torch.int8: np.int8, torch.int16: np.int16, torch.int32: np.int32, torch.int64: np.int64}
+# Largest value of each output datatype, the tiff stacks are clipped to it
+datatype_max_values = {np.dtype(t): (np.finfo(t).max if np.issubdtype(t, np.floating) else np.iinfo(t).max)
+    for t in torch_to_numpy_datatypes.values()}
+
+def read_image_stack(filename, maxWorkers=10):
+    'Memory-maps the image stack when possible, frames are then only read from disk when accessed'
+    try:
+        return memmap(filename, mode='r')
+    except ValueError:
+        # Compressed or fragmented stacks can't be mapped, decode them entirely
+        return imread(filename, maxworkers=maxWorkers)
+
+def get_image_crop(image_shape, out_shape):
+    'Source window equivalent to pad_img_to_min followed by center_crop'
+    h,w = image_shape[-2:]
+    min_size = min(h,w)
+    # pad_img_to_min only crops: the rows by (h-min_size) on both ends and the columns by (w-min_size)/2 rounded up
+    top = h-min_size
+    left = -((min_size-w)//2)
+    top += (h-2*top - out_shape[0])//2
+    left += (w-2*left - out_shape[1])//2
+    return slice(top, top+out_shape[0]), slice(left, left+out_shape[1])
+
+# Output shape and copy windows of pad_img_to_min, per input image shape
+pad_img_to_min_windows = {}
+
+def get_pad_img_to_min_window(image_shape):
+    'Output shape, source and destination slices of pad_img_to_min for an image of image_shape'
+    image_shape = tuple(image_shape[-2:])
+    if image_shape not in pad_img_to_min_windows:
+        min_size = min(image_shape)
+        # Same padding on both sides of each dim, negative values crop
+        img_pad = [min_size-image_shape[0], (min_size-image_shape[1])//2]
+        out_shape = [n+2*p for p,n in zip(img_pad, image_shape)]
+        src = tuple(slice(max(-p,0), n-max(-p,0)) for p,n in zip(img_pad, image_shape))
+        dst = tuple(slice(max(p,0), n-max(p,0)) for p,n in zip(img_pad, out_shape))
+        pad_img_to_min_windows[image_shape] = (out_shape, src, dst)
+    return pad_img_to_min_windows[image_shape]
+
+def split_in_chunks(tensor, max_elements=2**26):
+    'Splits a tensor along its first dimension in chunks of at most max_elements'
+    if tensor.dim()==0 or tensor.shape[0]==0:
+        return [tensor]
+    chunk_size = max(1, max_elements // max(1, tensor[0].numel()))
+    return tensor.split(chunk_size)
+
+def dequantize_volumes(vols, scale, offset, out_datatype=torch.float16):
+    'Int8 volumes [...,depths,H,W] back to floating point with their per depth scale and offset'
+    return (vols.float() * scale.float().unsqueeze(-1).unsqueeze(-1) + offset.float().unsqueeze(-1).unsqueeze(-1)).to(out_datatype)
+
+def get_float_chunks(tensor, scale=None, offset=None):
+    'Float32 chunks of a tensor along its first dimension, dequantized if a scale and offset are given'
+    chunks = split_in_chunks(tensor)
+    if scale is None:
+        return (chunk.float() for chunk in chunks)
+    chunk_size = chunks[0].shape[0]
+    return (dequantize_volumes(chunk, scale[n*chunk_size:(n+1)*chunk_size], offset[n*chunk_size:(n+1)*chunk_size], torch.float32)
+            for n,chunk in enumerate(chunks))
+
+def get_tensor_max(tensor, scale=None, offset=None):
+    'Max of a tensor, reduced in float32 chunk by chunk instead of from a full float32 copy'
+    out_datatype = tensor.dtype if scale is None else scale.dtype
+    return torch.stack([chunk.max() for chunk in get_float_chunks(tensor, scale, offset)]).max().to(out_datatype)
+
+def get_tensor_mean_std(tensor, scale=None, offset=None):
+    'Mean and (unbiased) std of a tensor, accumulated chunk by chunk in float32/float64'
+    out_datatype = tensor.dtype if scale is None else scale.dtype
+    counts, means, sq_diffs = [], [], []
+    for chunk in get_float_chunks(tensor, scale, offset):
+        counts.append(chunk.numel())
+        means.append(chunk.mean().double())
+        sq_diffs.append(chunk.var(unbiased=False).double() * chunk.numel())
+    # Merge the per chunk moments
+    counts = torch.tensor(counts, dtype=torch.float64)
+    means, sq_diffs = torch.stack(means), torch.stack(sq_diffs)
+    mean = (counts*means).sum() / counts.sum()
+    var = (sq_diffs + counts*(means-mean)**2).sum() / (counts.sum()-1)
+    return mean.to(out_datatype), var.sqrt().to(out_datatype)
+
+# Gather indices and sampling grids of extract_views, the lenslet coordinates don't change between calls
+lenslet_views_cache = {}
+
+def get_lenslet_views_key(kind, lenslet_coords, subimage_shape, image_shape, device):
+    return (kind, lenslet_coords.cpu().numpy().tobytes(), tuple(subimage_shape), tuple(image_shape), str(device))
+
+def get_lenslet_views_indices(lenslet_coords, subimage_shape, image_shape, device='cpu'):
+    'Row and column indices of every lenslet view, pixels outside the image index the zero padding past its border'
+    key = get_lenslet_views_key('indices', lenslet_coords, subimage_shape, image_shape, device)
+    if key in lenslet_views_cache:
+        return lenslet_views_cache[key]
+    indices = []
+    for dim in range(2):
+        view_size, half_size, img_size = subimage_shape[dim], subimage_shape[dim]//2, image_shape[dim]
+        coords = lenslet_coords[:,dim].long().to(device)
+        lower_bounds = (coords-half_size).clamp(min=0)
+        lengths = ((coords+half_size).clamp(max=img_size) - lower_bounds).clamp(min=0)
+        # Views cut by the image border are aligned to the end of the subimage
+        offsets = torch.arange(view_size, device=device)
+        start = (view_size-lengths).unsqueeze(1)
+        indices.append((lower_bounds.unsqueeze(1) + offsets - start).masked_fill(offsets < start, img_size))
+    lenslet_views_cache[key] = (indices[0], indices[1])
+    return lenslet_views_cache[key]
+
+def get_lenslet_views_grid(lenslet_coords, subimage_shape, image_shape, device):
+    'Normalized grid_sample coordinates [1, n_lenslets*subH, subW, 2] of every lenslet view'
+    key = get_lenslet_views_key('grid', lenslet_coords, subimage_shape, image_shape, device)
+    if key in lenslet_views_cache:
+        return lenslet_views_cache[key]
+    if str(device) != 'cpu':
+        # Built from the cached CPU indices and copied over once
+        lenslet_views_cache[key] = get_lenslet_views_grid(lenslet_coords, subimage_shape, image_shape, 'cpu').to(device)
+    else:
+        rows, cols = get_lenslet_views_indices(lenslet_coords, subimage_shape, image_shape)
+        inside = (rows < image_shape[0]).unsqueeze(2) & (cols < image_shape[1]).unsqueeze(1)
+        rows = rows.unsqueeze(2).expand(inside.shape).float()
+        cols = cols.unsqueeze(1).expand(inside.shape).float()
+        # Pixels outside the image point out of bounds and are sampled as zeros
+        rows[~inside], cols[~inside] = -1, -1
+        grid = torch.stack((2*cols/max(image_shape[1]-1,1)-1, 2*rows/max(image_shape[0]-1,1)-1), dim=-1)
+        lenslet_views_cache[key] = grid.view(1, -1, subimage_shape[1], 2)
+    return lenslet_views_cache[key]
+
+@torch.jit.script
+def gather_lenslet_views(image, rows, cols):
+    'Lenslet views [B,C,n_lenslets,subH,subW] of image, pixels outside the image read a zero padded row or column'
+    image = F.pad(image, [0,1,0,1])
+    return image[:,:,rows.unsqueeze(2),cols.unsqueeze(1)]
+
+def add_shot_noise_to_chunk(chunk, chunk_power, seed=None):
+    'Adds camera noise in place to a chunk of images, at the signal power [n_images,1,...] of each image'
+    if seed is not None:
+        # Pool workers are forked with the same random state
+        torch.manual_seed(seed)
+        torch.set_num_threads(1)
+    img_stacks = chunk.float()
+    curr_max = img_stacks.view(chunk.shape[0],-1).amax(1).view(chunk_power.shape)
+    img_stacks = chunk_power * img_stacks / curr_max
+
+    img_stacks = pytorch_shot_noise.add_camera_noise(img_stacks)
+    chunk[...] = curr_max * img_stacks.float() / chunk_power
+
+def get_segmentation_indices(seg_vol):
+    'Voxel coordinates [n_voxels, seg_vol.ndim] of every label in seg_vol, as (seg_vol == label).nonzero() returns them'
+    labels = seg_vol.long().view(-1)
+    neurons, inverse = torch.unique(labels, return_inverse=True)
+    # Group the voxels by label in a single sort, keeping them in row-major order within each label
+    positions = torch.arange(labels.numel())
+    positions = positions[torch.argsort(inverse * labels.numel() + positions)]
+    coords = []
+    for size in reversed(seg_vol.shape):
+        coords.insert(0, positions % size)
+        positions = positions // size
+    coords = torch.stack(coords, 1)
+    return dict(zip(neurons.tolist(), coords.split(torch.bincount(inverse).tolist())))
+
+def read_cached_volume(read_tiff_stack, filename, cache_dir=None):
+    'Decodes a volume, keeping a .npy copy in cache_dir that later runs memory-map instead of decoding the tiff again'
+    # Volumes are already read in parallel, decode each one in a single thread
+    if cache_dir is None:
+        return read_tiff_stack(filename, max_workers=1)
+    # The datasets decode volumes differently, keep a copy per reader
+    cache_key = read_tiff_stack.__qualname__ + os.path.abspath(filename)
+    cache_path = os.path.join(cache_dir, hashlib.md5(cache_key.encode()).hexdigest() + '.npy')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(filename):
+        return torch.from_numpy(np.load(cache_path, mmap_mode='c'))
+    currVol = read_tiff_stack(filename, max_workers=1)
+    # Write to a temporary file first, an interrupted run must not leave a truncated cache behind
+    with open(cache_path + '.tmp', 'wb') as f:
+        np.save(f, currVol.numpy())
+    os.replace(cache_path + '.tmp', cache_path)
+    return currVol
+
+def normalize_sample(sample, normalization=None):
+    'Subtracts the mean and multiplies by the inverse std of normalization in float32, keeping the sample datatype'
+    if normalization is None:
+        return sample
+    mean, inv_std = normalization
+    return ((sample.float() - mean) * inv_std).to(sample.dtype)
+
+def read_volume_array(read_tiff_stack, cache_dir, filename):
+    'Process pool worker, decodes a volume and sends it back as a numpy array'
+    return read_cached_volume(read_tiff_stack, filename, cache_dir).numpy()
 
 class XLFMDatasetFull(data.Dataset):
     def __init__(self, data_path, lenslet_coords_path, subimage_shape, img_shape, images_to_use=None, lenslets_offset=50, n_depths_to_fill=120, border_blanking=10,
-     load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10):
+     load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10, pin_memory=False, memory_format=torch.contiguous_format,
+     quantize_vols=False, use_processes=False, share_memory=False, cache_dir=None):
+        if share_memory and pin_memory:
+            # pin_memory() copies the tensors out of shared memory, one flag would silently undo the other
+            raise ValueError('share_memory and pin_memory can not be used together')
         # Load lenslets coordinates
         self.lenslet_coords = get_lenslet_centers(lenslet_coords_path) + torch.tensor(lenslets_offset)
         self.n_lenslets = self.lenslet_coords.shape[0]
@@ -37,11 +223,31 @@ class XLFMDatasetFull(data.Dataset):
         self.temporal_shifts = temporal_shifts
         self.n_frames = len(temporal_shifts)
         self.use_random_shifts = use_random_shifts
+        # Frame offsets added to the sample index in __getitem__
+        self.shift_offsets = torch.tensor(temporal_shifts, dtype=torch.long)
+        # The sample layout is fixed, pick the __getitem__ implementation once.
+        # Unbound functions are stored, bound methods would make the dataset reference itself
+        cls = type(self)
+        self.getitem_impl = cls.get_views_and_volumes if load_vols else cls.get_views
         self.vol_type = torch.float16
+        self.quantize_vols = quantize_vols and load_vols
+        self.vols_scale, self.vols_offset = None, None
+        # Decoded volumes are cached as .npy files in cache_dir
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # Normalization statistics, computed on the first get_statistics call
+        self.statistics = None
+        # Voxel coordinates of each neuron of seg_vol, built on the first get_voltages_from_volume call
+        self.neuron_indices = None
+        # Mean and inverse std applied to each sample when it's fetched, set by standarize(in_place=False)
+        self.views_normalization, self.vols_normalization = None, None
 
         self.img_shape = img_shape
         self.subimage_shape = subimage_shape
         self.half_subimg_shape = [self.subimage_shape[0]//2,self.subimage_shape[1]//2]
+        # Build the extract_views indices once, the views are extracted from images of img_shape
+        get_lenslet_views_indices(self.lenslet_coords, self.subimage_shape, self.img_shape)
 
         # Tiff images are stored in single tiff stack
         # Volumes are stored in individual tiff stacks
@@ -49,12 +255,12 @@ class XLFMDatasetFull(data.Dataset):
         imgs_path_sparse = data_path + '/XLFM_image/XLFM_image_stack_S.tif'
         vols_path = data_path + '/XLFM_stack/*.tif'
 
-        self.img_dataset = imread(imgs_path, maxworkers=maxWorkers)
+        self.img_dataset = read_image_stack(imgs_path, maxWorkers)
         n_frames,h,w = self.img_dataset.shape
 
         if self.load_sparse:
             try:
-                self.img_dataset_sparse = imread(imgs_path_sparse, maxworkers=maxWorkers)
+                self.img_dataset_sparse = read_image_stack(imgs_path_sparse, maxWorkers)
             except:
                 self.load_sparse = False
                 print('Dataset error: Sparse dir XLFM_image/XLFM_image_stack_S.tif not found')
@@ -67,13 +273,14 @@ class XLFMDatasetFull(data.Dataset):
 
         self.all_files = sorted(glob.glob(vols_path))
         if len(self.all_files)>0 and load_vols:
-            self.all_files = [sorted(glob.glob(vols_path))[images_to_use[i]] for i in range(self.n_images)]
+            self.all_files = [self.all_files[images_to_use[i]] for i in range(self.n_images)]
 
         if self.load_sparse:
             vols_path_sparse = data_path + '/XLFM_stack_S/*.tif'
         if load_vols:
             if self.load_sparse:
-                self.all_files= [sorted(glob.glob(vols_path_sparse))[images_to_use[i]] for i in range(self.n_images)]
+                all_files_sparse = sorted(glob.glob(vols_path_sparse))
+                self.all_files= [all_files_sparse[images_to_use[i]] for i in range(self.n_images)]
             # read single volume
             currVol = self.read_tiff_stack(self.all_files[0])
             odd_size = [currVol.shape[0], currVol.shape[1]]
@@ -82,49 +289,77 @@ class XLFMDatasetFull(data.Dataset):
             half_volume_shape = [odd_size[0]//2,odd_size[1]//2]
             self.volStart = [currVol.shape[0]//2-half_volume_shape[0], currVol.shape[1]//2-half_volume_shape[1]]
             self.volEnd = [odd_size[n] + self.volStart[n] for n in range(len(self.volStart))]
-            self.vols = torch.zeros(n_images_to_load, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
+            self.vol_crop = (slice(self.volStart[0],self.volEnd[0]), slice(self.volStart[1],self.volEnd[1]))
+            n_vol_depths = currVol.shape[2]
+            # Depths are the channels of the networks, torch.channels_last stores them innermost
+            self.vols = torch.zeros(n_images_to_load, n_depths_to_fill, odd_size[0], odd_size[1], dtype=torch.int8 if self.quantize_vols else self.vol_type)\
+                .contiguous(memory_format=memory_format)
+            if self.quantize_vols:
+                # Volumes are stored as int8 with a per depth scale and offset
+                self.vols_scale = torch.ones(n_images_to_load, n_depths_to_fill, dtype=self.vol_type)
+                self.vols_offset = torch.zeros(n_images_to_load, n_depths_to_fill, dtype=torch.float32)
             
         else:
             odd_size = self.subimage_shape
             self.vols = 255*torch.ones(1)
         
-        # Create image storage
-        self.stacked_views = torch.zeros(n_images_to_load, self.img_shape[0], self.img_shape[1],dtype=torch.float16)
-        
-        if self.load_sparse:
-            stacked_views_sparse = self.stacked_views.clone()
+        # Create image storage, sparse images are stored along the last dimension
+        self.stacked_views = torch.zeros([n_images_to_load, self.img_shape[0], self.img_shape[1]] + ([2] if self.load_sparse else []), dtype=torch.float16)
+        dense_views = self.stacked_views[...,0] if self.load_sparse else self.stacked_views
+        img_rows,img_cols = get_image_crop(self.img_dataset.shape, self.img_shape)
+
+        if load_vols:
+            vol_files = [self.all_files[nImg] for nImg in range(n_images_to_load)]
+            if use_processes:
+                # Decode in worker processes, for tiff decoders that hold the GIL
+                with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+                    for nImg,currVol in enumerate(tqdm(executor.map(partial(read_volume_array, self.read_tiff_stack, self.cache_dir), vol_files),
+                        total=n_images_to_load, desc="Loading Vol...")):
+                        self.store_volume(nImg, torch.from_numpy(currVol))
+            else:
+                # Volumes are decoded in parallel, the tiff decoder releases the GIL
+                with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                    list(tqdm(executor.map(self.load_volume, range(n_images_to_load), vol_files), total=n_images_to_load, desc="Loading Vol..."))
+            # Blank the borders of all volumes at once
+            if border_blanking>0:
+                # Value of a zero voxel, quantized volumes encode it with a per depth code
+                blank = torch.zeros(1, self.vols.shape[1], 1, 1, dtype=self.vols.dtype)
+                if self.quantize_vols:
+                    blank = (-self.vols_offset / self.vols_scale.float()).round_().clamp_(-127,127).to(torch.int8).unsqueeze(-1).unsqueeze(-1)
+                self.vols[:,:border_blanking,...] = blank[:,:border_blanking]
+                self.vols[:,max(n_vol_depths-border_blanking,0):n_vol_depths,...] = blank[:,max(n_vol_depths-border_blanking,0):n_vol_depths]
+                self.vols[:,:,:border_blanking,:] = blank
+                self.vols[:,:,-border_blanking:,:] = blank
+                self.vols[:,:,:,:border_blanking] = blank
+                self.vols[:,:,:,-border_blanking:] = blank
 
         for nImg in range(n_images_to_load):
 
             # Load the images indicated from the user
             curr_img = nImg#images_to_use[nImg]
 
-            if load_vols:
-                currVol = self.read_tiff_stack(self.all_files[curr_img])
-                assert not torch.isinf(currVol).any()
-                if border_blanking>0:
-                    currVol[:border_blanking,...] = 0
-                    currVol[-border_blanking:,...] = 0
-                    currVol[:,:border_blanking,...] = 0
-                    currVol[:,-border_blanking:,...] = 0
-                    currVol[:,:,:border_blanking] = 0
-                    currVol[:,:,-border_blanking:] = 0
-                self.vols[nImg,:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
-                    [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
-
             
-            image = torch.from_numpy(np.array(self.img_dataset[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-
-            image = self.pad_img_to_min(image)
-            self.stacked_views[nImg,...] = center_crop(image.unsqueeze(0).unsqueeze(0), self.img_shape)[0,0,...]
+            # Crop and cast straight into the image storage, numpy() shares its memory
+            np.copyto(dense_views[nImg,...].numpy(), self.img_dataset[curr_img,img_rows,img_cols], casting='unsafe')
             
             if self.load_sparse:
-                image = torch.from_numpy(np.array(self.img_dataset_sparse[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-                image = self.pad_img_to_min(image)
-                stacked_views_sparse[nImg,...] = image
+                np.copyto(self.stacked_views[nImg,...,1].numpy(), self.img_dataset_sparse[curr_img,img_rows,img_cols], casting='unsafe')
 
-        if self.load_sparse:
-            self.stacked_views = torch.cat((self.stacked_views.unsqueeze(-1), stacked_views_sparse.unsqueeze(-1)), dim=3)
+        # DataLoader workers started with spawn/forkserver map tensors in shared memory instead of each receiving a copy of the dataset
+        if share_memory:
+            self.stacked_views.share_memory_()
+            if load_vols:
+                self.vols.share_memory_()
+                if self.quantize_vols:
+                    self.vols_scale.share_memory_()
+                    self.vols_offset.share_memory_()
+
+        # Page-locked storage lets slices be copied to the GPU with non_blocking=True.
+        # The pinned pages can't be swapped out, so don't also raise the DataLoader prefetch_factor blindly.
+        if pin_memory and torch.cuda.is_available():
+            self.stacked_views = self.stacked_views.pin_memory()
+            if load_vols:
+                self.vols = self.vols.pin_memory()
 
         print('Loaded ' + str(self.n_images))  
 
@@ -141,32 +376,57 @@ class XLFMDatasetFull(data.Dataset):
     def get_max(self):
         'Get max intensity from volumes and images for normalization'
         if self.load_sparse:
-            return  self.stacked_views[...,0].float().max().type(self.stacked_views.type()),\
-                    self.stacked_views[...,1].float().max().type(self.stacked_views.type()),\
-                    self.vols.float().max().type(self.vols.type())
+            return  get_tensor_max(self.stacked_views[...,0]),\
+                    get_tensor_max(self.stacked_views[...,1]),\
+                    get_tensor_max(self.vols, self.vols_scale, self.vols_offset)
         else:
-            return self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.vols.float().max().type(self.vols.type())
+            max_imgs = get_tensor_max(self.stacked_views)
+            return max_imgs, max_imgs.clone(), get_tensor_max(self.vols, self.vols_scale, self.vols_offset)
 
     def get_statistics(self):
         'Get mean and standard deviation from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().mean().type(self.stacked_views.type()), self.stacked_views[...,0].float().std().type(self.stacked_views.type()), \
-                    self.stacked_views[...,1].float().mean().type(self.stacked_views.type()), self.stacked_views[...,1].float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-        else:
-            return  self.stacked_views.float().mean().type(self.stacked_views.type()), self.stacked_views.float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-
-    def standarize(self, stats=None):
+        if self.statistics is None:
+            if self.load_sparse:
+                self.statistics = (*get_tensor_mean_std(self.stacked_views[...,0]), \
+                                *get_tensor_mean_std(self.stacked_views[...,1]), \
+                                *get_tensor_mean_std(self.vols, self.vols_scale, self.vols_offset))
+            else:
+                self.statistics = (*get_tensor_mean_std(self.stacked_views), \
+                                *get_tensor_mean_std(self.vols, self.vols_scale, self.vols_offset))
+        return self.statistics
+
+    def standarize(self, stats=None, in_place=True):
+        if stats is None:
+            stats = self.get_statistics()
+            if not self.load_sparse:
+                # There is no sparse channel to normalize
+                stats = stats[:2] + (0, 1) + stats[2:]
         mean_imgs, std_imgs, mean_imgs_s, std_imgs_s, mean_vols, std_vols = stats
+        # The data changes, the cached statistics are no longer valid
+        self.statistics = None
+        # The reciprocals are computed once in double precision, the passes over the data only multiply
+        inv_std_vols = 1.0/float(std_vols)
+        if self.quantize_vols:
+            # Standardizing the int8 volumes only changes their scale and offset
+            self.vols_offset.sub_(mean_vols).mul_(inv_std_vols)
+            self.vols_scale.mul_(inv_std_vols)
+        if not in_place:
+            # Keep the stored data as is and normalize every sample in __getitem__, skipping the pass over the dataset
+            if self.load_sparse:
+                self.views_normalization = (torch.tensor([float(mean_imgs), float(mean_imgs_s)]), torch.tensor([1.0/float(std_imgs), 1.0/float(std_imgs_s)]))
+            else:
+                self.views_normalization = (torch.tensor(float(mean_imgs)), torch.tensor(1.0/float(std_imgs)))
+            if not self.quantize_vols:
+                self.vols_normalization = (torch.tensor(float(mean_vols)), torch.tensor(inv_std_vols))
+            return
+        # Normalize in place, no temporary copies of the whole dataset
         if self.load_sparse:
-            self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
-            self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
+            self.stacked_views[...,0].sub_(mean_imgs).mul_(1.0/float(std_imgs))
+            self.stacked_views[...,1].sub_(mean_imgs_s).mul_(1.0/float(std_imgs_s))
         else:
-            self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
-        self.vols = (self.vols-mean_vols) / std_vols
+            self.stacked_views.sub_(mean_imgs).mul_(1.0/float(std_imgs))
+        if not self.quantize_vols:
+            self.vols.sub_(mean_vols).mul_(inv_std_vols)
 
     def len_lenslets(self):
         'Denotes the total number of lenslets'
@@ -176,84 +436,139 @@ class XLFMDatasetFull(data.Dataset):
         return self.lenslet_coords
 
     def pad_img_to_min(self,image):
-        min_size = min(image.shape[-2:])
-        img_pad = [min_size-image.shape[-1], min_size-image.shape[-2]]
-        img_pad = [img_pad[0]//2, img_pad[0]//2, img_pad[1],img_pad[1]]
-        image = F.pad(image.unsqueeze(0).unsqueeze(0), img_pad)[0,0]
-        return image
+        out_shape, src, dst = get_pad_img_to_min_window(image.shape)
+        out = torch.zeros(out_shape, dtype=image.dtype, device=image.device)
+        out[dst] = image[src]
+        return out
+
+    def load_volume(self, nImg, filename):
+        'Reads a single volume from disk and stores it in self.vols[nImg]'
+        self.store_volume(nImg, read_cached_volume(self.read_tiff_stack, filename, self.cache_dir))
+
+    @torch.no_grad()
+    def store_volume(self, nImg, currVol):
+        'Stores a [H,W,depths] volume in self.vols[nImg]'
+        assert not torch.isinf(currVol).any()
+        rows,cols = self.vol_crop
+        currVol = currVol.permute(2,0,1)[:,rows,cols]
+        if self.quantize_vols:
+            # Map the [min(min,0), max(max,0)] range of each depth onto the whole int8 range [-127,127]
+            currVol = currVol.float()
+            lower = currVol.amin(dim=(1,2)).clamp(max=0)
+            scale = ((currVol.amax(dim=(1,2)).clamp(min=0) - lower) / 254).to(self.vol_type)
+            scale[scale==0] = 1
+            # The offset is kept in float32, so zero is exactly representable (code -127) for non negative volumes
+            offset = lower + 127*scale.float()
+            self.vols_scale[nImg,:currVol.shape[0]] = scale
+            self.vols_offset[nImg,:currVol.shape[0]] = offset
+            currVol = ((currVol - offset.unsqueeze(1).unsqueeze(2)) / scale.float().unsqueeze(1).unsqueeze(2)).round_().clamp_(-127,127).to(torch.int8)
+        self.vols[nImg,:currVol.shape[0],:,:] = currVol
+
+    def get_volumes(self, index):
+        'Returns the volumes at index, dequantized if quantize_vols is enabled'
+        if self.vols_scale is not None:
+            return dequantize_volumes(self.vols[index,...], self.vols_scale[index], self.vols_offset[index], self.vol_type)
+        return normalize_sample(self.vols[index,...], self.vols_normalization)
+
+    def get_frame_views(self, indices):
+        'Images of the given frames, normalized if standarize was called with in_place=False'
+        return normalize_sample(self.stacked_views.index_select(0, indices), self.views_normalization)
 
     def __getitem__(self, index):
-        n_frames = self.get_n_temporal_frames()
-        new_index = self.images_to_use[index]
-        
-        temporal_shifts_ixs = self.temporal_shifts
-        # if self.use_random_shifts:
-        #     temporal_shifts_ixs = torch.randint(0, self.n_images-1,[3]).numpy()
-        #     newIndex = 0
+        return self.getitem_impl(self, index)
 
-        indices = [new_index + temporal_shifts_ixs[i] for i in range(n_frames)]
-        
-        views_out = self.stacked_views[indices,...]
-        if self.load_vols is False:
-            return views_out,0
-        vol_out = self.vols[index,...]
-        
-        return views_out,vol_out
+    def get_views(self, index):
+        'Temporal frames of a sample, without volumes'
+        return self.get_frame_views(self.shift_offsets + self.images_to_use[index]),0
+
+    def get_views_and_volumes(self, index):
+        views_out = self.get_frame_views(self.shift_offsets + self.images_to_use[index])
+        return views_out,self.get_volumes(index)
 
     
     def get_voltages_from_volume(self, vol, neuron):
-        index = (self.seg_vol.long() == neuron).nonzero()
+        if self.neuron_indices is None:
+            self.neuron_indices = get_segmentation_indices(self.seg_vol)
+        # Labels are matched as integers, like seg_vol.long() == neuron, tensors and numpy scalars included
+        label = neuron.item() if hasattr(neuron, 'item') else neuron
+        if label == int(label) and int(label) in self.neuron_indices:
+            index = self.neuron_indices[int(label)]
+        else:
+            # Only labels that don't appear in seg_vol select no voxels
+            index = torch.zeros(0, self.seg_vol.ndim, dtype=torch.long)
         
         return vol[index]
 
     @staticmethod
     def extract_views(image, lenslet_coords, subimage_shape, debug=False):
-        half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
-        n_lenslets = lenslet_coords.shape[0]
-        stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+        if image.is_cuda and image.dtype==torch.float32:
+            # Sample all patches in one kernel, half precision grids can't address large images exactly
+            B,C,H,W = image.shape
+            grid = get_lenslet_views_grid(lenslet_coords, subimage_shape, [H,W], image.device)
+            stacked_views = F.grid_sample(image.reshape(B*C,1,H,W), grid.expand(B*C,-1,-1,-1), mode='nearest', padding_mode='zeros', align_corners=True)
+            stacked_views = stacked_views.view(B, C, -1, subimage_shape[0], subimage_shape[1])
+        else:
+            # Grab all patches with a single gather, pixels outside the image are zeroed
+            rows, cols = get_lenslet_views_indices(lenslet_coords, subimage_shape, image.shape[-2:], image.device)
+            stacked_views = gather_lenslet_views(image, rows, cols)
         
         if debug:
             debug_image = image.detach().clone()
             max_img = image.float().cpu().max()
-        for nLens in range(n_lenslets):
-            # Fetch coordinates
-            currCoords = lenslet_coords[nLens,:]
-            if debug:
+            for nLens in range(lenslet_coords.shape[0]):
+                currCoords = lenslet_coords[nLens,:]
                 debug_image[:,:,currCoords[0]-2:currCoords[0]+2,currCoords[1]-2:currCoords[1]+2] = max_img
-            # Grab patches
-            lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
-            lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
-            currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
-            stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
-        
-        if debug:
             import matplotlib.pyplot as plt
             plt.imshow(debug_image[0,0,...].float().cpu().detach().numpy())
             plt.show()
         return stacked_views
         
     @staticmethod
-    def read_tiff_stack(filename, out_datatype=torch.float16):
-        tiffarray = mtif.read_stack(filename, units='voxels')
-        try:
-            max_val = torch.iinfo(out_datatype).max
-        except:
-            max_val = torch.finfo(out_datatype).max
-        out = np.clip(tiffarray.raw_images, 0, max_val)
-        return torch.from_numpy(out).permute(1,2,0).type(out_datatype)
-
-    def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2]):
-        for nImg in range(self.stacked_views.shape[0]):
-            signal_power = (signal_power_range[0] + (signal_power_range[1]-signal_power_range[0]) * torch.rand(1)).item()
-            
-            curr_img_stack = self.stacked_views[nImg,...].float()
-            curr_max = curr_img_stack.max()
-            curr_img_stack = signal_power * curr_img_stack / curr_max
-                
-            for kk in range(curr_img_stack.shape[0]):
-                curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
-            curr_img_stack = curr_max * curr_img_stack.float() / signal_power
-            self.stacked_views[nImg,...] = curr_img_stack
+    def read_tiff_stack(filename, out_datatype=torch.float16, max_workers=None):
+        if max_workers is None:
+            max_workers = max(1, os.cpu_count()//2)
+        # tifffile decodes the pages in parallel
+        tiffarray = imread(filename, maxworkers=max_workers)
+        if tiffarray.ndim == 2:
+            tiffarray = tiffarray[np.newaxis]
+        np_datatype = np.dtype(torch_to_numpy_datatypes.get(out_datatype, out_datatype))
+        max_val = datatype_max_values[np_datatype]
+        # Clip straight into an array of the output type, torch.from_numpy then shares its memory
+        out = tiffarray if tiffarray.dtype==np_datatype else np.empty_like(tiffarray, dtype=np_datatype)
+        np.clip(tiffarray, 0, max_val, out=out, casting='unsafe')
+        return torch.from_numpy(out).permute(1,2,0)
+
+    def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2], n_processes=0):
+        n_images = self.stacked_views.shape[0]
+        # One signal power and max per image, broadcasted over the rest of the dimensions
+        per_image_shape = [n_images] + [1]*(self.stacked_views.ndim-1)
+        signal_power = torch.empty(n_images, device=self.stacked_views.device).uniform_(signal_power_range[0], signal_power_range[1]).view(per_image_shape)
+
+        # The camera noise is elementwise, apply it to whole chunks of images at once.
+        # Chunking caps the float32 working set instead of copying the entire dataset
+        if n_processes > 0:
+            # Split in at least one slab per process. The workers noise up to n_processes slabs at a time in a
+            # shared memory buffer that is copied back, the dataset storage itself is left as is (e.g. pinned)
+            chunks = split_in_chunks(self.stacked_views, min(2**26, -(-self.stacked_views.numel()//n_processes)))
+            chunk_powers = signal_power.split(chunks[0].shape[0])
+            slab_size = chunks[0].shape[0]
+            buffer = torch.empty([n_processes*slab_size] + list(self.stacked_views.shape[1:]), dtype=self.stacked_views.dtype).share_memory_()
+            with torch.multiprocessing.Pool(n_processes) as pool:
+                for start in range(0, len(chunks), n_processes):
+                    curr_chunks = chunks[start:start+n_processes]
+                    slabs = [buffer[n*slab_size:n*slab_size+chunk.shape[0]] for n,chunk in enumerate(curr_chunks)]
+                    for slab, chunk in zip(slabs, curr_chunks):
+                        slab.copy_(chunk)
+                    seeds = torch.randint(2**31, [len(curr_chunks)]).tolist()
+                    pool.starmap(add_shot_noise_to_chunk, zip(slabs, chunk_powers[start:start+n_processes], seeds))
+                    for slab, chunk in zip(slabs, curr_chunks):
+                        chunk.copy_(slab)
+            del buffer
+        else:
+            chunks = split_in_chunks(self.stacked_views)
+            for chunk, chunk_power in zip(chunks, signal_power.split(chunks[0].shape[0])):
+                add_shot_noise_to_chunk(chunk, chunk_power)
+        self.statistics = None
         print("Added noise to " + str(self.stacked_views.shape[0]) + " images.")
 
 
@@ -263,7 +578,11 @@ class XLFMDatasetFull(data.Dataset):
 
 class XLFMDatasetFullRegistration(data.Dataset):
     def __init__(self, data_path, lenslet_coords_path, subimage_shape, img_shape, images_to_use=None, lenslets_offset=50, n_depths_to_fill=120, border_blanking=10,
-     load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10):
+     load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10, pin_memory=False, memory_format=torch.contiguous_format,
+     quantize_vols=False, use_processes=False, share_memory=False, cache_dir=None):
+        if share_memory and pin_memory:
+            # pin_memory() copies the tensors out of shared memory, one flag would silently undo the other
+            raise ValueError('share_memory and pin_memory can not be used together')
         # Load lenslets coordinates
         self.lenslet_coords = get_lenslet_centers(lenslet_coords_path) + torch.tensor(lenslets_offset)
         self.n_lenslets = self.lenslet_coords.shape[0]
@@ -272,11 +591,37 @@ class XLFMDatasetFullRegistration(data.Dataset):
         self.load_sparse = load_sparse
         self.temporal_shifts = temporal_shifts
         self.use_random_shifts = use_random_shifts
+        # Frame offsets added to the sample index in __getitem__, only non contiguous shifts are used as given
+        self.n_frames = len(temporal_shifts)
+        self.shift_offsets = torch.arange(self.n_frames)
+        self.random_shifts = False
+        if len(temporal_shifts)>0 and not sorted(temporal_shifts) == list(range(min(temporal_shifts), max(temporal_shifts)+1)):
+            self.shift_offsets = torch.tensor(temporal_shifts, dtype=torch.long)
+            self.random_shifts = use_random_shifts
+        # The sample layout is fixed, pick the __getitem__ implementation once.
+        # Unbound functions are stored, bound methods would make the dataset reference itself
+        cls = type(self)
+        self.frame_indices_impl = cls.get_random_frame_indices if self.random_shifts else cls.get_shifted_frame_indices
+        self.getitem_impl = cls.get_views_and_volumes if load_vols else cls.get_views
         self.vol_type = torch.float16
+        self.quantize_vols = quantize_vols and load_vols
+        self.vols_scale, self.vols_offset = None, None
+        # Decoded volumes are cached as .npy files in cache_dir
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # Normalization statistics, computed on the first get_statistics call
+        self.statistics = None
+        # Voxel coordinates of each neuron of seg_vol, built on the first get_voltages_from_volume call
+        self.neuron_indices = None
+        # Mean and inverse std applied to each sample when it's fetched, set by standarize(in_place=False)
+        self.views_normalization, self.vols_normalization = None, None
 
         self.img_shape = img_shape
         self.subimage_shape = subimage_shape
         self.half_subimg_shape = [self.subimage_shape[0]//2,self.subimage_shape[1]//2]
+        # Build the extract_views indices once, the views are extracted from images of img_shape
+        get_lenslet_views_indices(self.lenslet_coords, self.subimage_shape, self.img_shape)
 
         # Tiff images are stored in single tiff stack
         # Volumes are stored in individual tiff stacks
@@ -285,12 +630,12 @@ class XLFMDatasetFullRegistration(data.Dataset):
         vols_path = data_path + '/XLFM_stack/*.tif'
 
         # dataset = Image.open(imgs_path)
-        self.img_dataset = imread(imgs_path, maxworkers=maxWorkers)
+        self.img_dataset = read_image_stack(imgs_path, maxWorkers)
         n_frames,h,w = np.shape(self.img_dataset)
 
         if self.load_sparse:
             try:
-                self.img_dataset_sparse = imread(imgs_path_sparse, maxworkers=maxWorkers)
+                self.img_dataset_sparse = read_image_stack(imgs_path_sparse, maxWorkers)
             except:
                 self.load_sparse = False
                 print('Dataset error: Sparse dir XLFM_image/XLFM_image_stack_S.tif not found')
@@ -301,13 +646,14 @@ class XLFMDatasetFullRegistration(data.Dataset):
 
         self.all_files = sorted(glob.glob(vols_path))
         if len(self.all_files)>0 and load_vols:
-            self.all_files = [sorted(glob.glob(vols_path))[images_to_use[i]] for i in range(self.n_images)]
+            self.all_files = [self.all_files[images_to_use[i]] for i in range(self.n_images)]
 
         if self.load_sparse:
             vols_path_sparse = data_path + '/XLFM_stack_S/*.tif'
         if load_vols:
             if self.load_sparse:
-                self.all_files= [sorted(glob.glob(vols_path_sparse))[images_to_use[i]] for i in range(self.n_images)]
+                all_files_sparse = sorted(glob.glob(vols_path_sparse))
+                self.all_files= [all_files_sparse[images_to_use[i]] for i in range(self.n_images)]
             # read single volume
             currVol = self.read_tiff_stack(self.all_files[0])
             odd_size = [currVol.shape[0], currVol.shape[1]]
@@ -316,49 +662,77 @@ class XLFMDatasetFullRegistration(data.Dataset):
             half_volume_shape = [odd_size[0]//2,odd_size[1]//2]
             self.volStart = [currVol.shape[0]//2-half_volume_shape[0], currVol.shape[1]//2-half_volume_shape[1]]
             self.volEnd = [odd_size[n] + self.volStart[n] for n in range(len(self.volStart))]
-            self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
+            self.vol_crop = (slice(self.volStart[0],self.volEnd[0]), slice(self.volStart[1],self.volEnd[1]))
+            n_vol_depths = currVol.shape[2]
+            # Depths are the channels of the networks, torch.channels_last stores them innermost
+            self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=torch.int8 if self.quantize_vols else self.vol_type)\
+                .contiguous(memory_format=memory_format)
+            if self.quantize_vols:
+                # Volumes are stored as int8 with a per depth scale and offset
+                self.vols_scale = torch.ones(self.n_images, n_depths_to_fill, dtype=self.vol_type)
+                self.vols_offset = torch.zeros(self.n_images, n_depths_to_fill, dtype=torch.float32)
             
         else:
             odd_size = self.subimage_shape
             self.vols = 255*torch.ones(1)
         
-        # Create image storage
-        self.stacked_views = torch.zeros(self.n_images, self.img_shape[0], self.img_shape[1],dtype=torch.float16)
-        
-        if self.load_sparse:
-            stacked_views_sparse = self.stacked_views.clone()
+        # Create image storage, sparse images are stored along the last dimension
+        self.stacked_views = torch.zeros([self.n_images, self.img_shape[0], self.img_shape[1]] + ([2] if self.load_sparse else []), dtype=torch.float16)
+        dense_views = self.stacked_views[...,0] if self.load_sparse else self.stacked_views
+        img_rows,img_cols = get_image_crop(self.img_dataset.shape, self.img_shape)
+
+        if load_vols:
+            vol_files = [self.all_files[images_to_use[nImg]] for nImg in range(self.n_images)]
+            if use_processes:
+                # Decode in worker processes, for tiff decoders that hold the GIL
+                with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+                    for nImg,currVol in enumerate(tqdm(executor.map(partial(read_volume_array, self.read_tiff_stack, self.cache_dir), vol_files),
+                        total=self.n_images, desc="Loading Vol...")):
+                        self.store_volume(nImg, torch.from_numpy(currVol))
+            else:
+                # Volumes are decoded in parallel, the tiff decoder releases the GIL
+                with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                    list(tqdm(executor.map(self.load_volume, range(self.n_images), vol_files), total=self.n_images, desc="Loading Vol..."))
+            # Blank the borders of all volumes at once
+            if border_blanking>0:
+                # Value of a zero voxel, quantized volumes encode it with a per depth code
+                blank = torch.zeros(1, self.vols.shape[1], 1, 1, dtype=self.vols.dtype)
+                if self.quantize_vols:
+                    blank = (-self.vols_offset / self.vols_scale.float()).round_().clamp_(-127,127).to(torch.int8).unsqueeze(-1).unsqueeze(-1)
+                self.vols[:,:border_blanking,...] = blank[:,:border_blanking]
+                self.vols[:,max(n_vol_depths-border_blanking,0):n_vol_depths,...] = blank[:,max(n_vol_depths-border_blanking,0):n_vol_depths]
+                self.vols[:,:,:border_blanking,:] = blank
+                self.vols[:,:,-border_blanking:,:] = blank
+                self.vols[:,:,:,:border_blanking] = blank
+                self.vols[:,:,:,-border_blanking:] = blank
 
         for nImg in range(self.n_images):
 
             # Load the images indicated from the user
             curr_img = images_to_use[nImg]
 
-            if load_vols:
-                currVol = self.read_tiff_stack(self.all_files[curr_img])
-                assert not torch.isinf(currVol).any()
-                if border_blanking>0:
-                    currVol[:border_blanking,...] = 0
-                    currVol[-border_blanking:,...] = 0
-                    currVol[:,:border_blanking,...] = 0
-                    currVol[:,-border_blanking:,...] = 0
-                    currVol[:,:,:border_blanking] = 0
-                    currVol[:,:,-border_blanking:] = 0
-                self.vols[nImg,:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
-                    [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
-
             
-            image = torch.from_numpy(np.array(self.img_dataset[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-
-            image = self.pad_img_to_min(image)
-            self.stacked_views[nImg,...] = center_crop(image.unsqueeze(0).unsqueeze(0), self.img_shape)[0,0,...]
+            # Crop and cast straight into the image storage, numpy() shares its memory
+            np.copyto(dense_views[nImg,...].numpy(), self.img_dataset[curr_img,img_rows,img_cols], casting='unsafe')
             
             if self.load_sparse:
-                image = torch.from_numpy(np.array(self.img_dataset_sparse[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-                image = self.pad_img_to_min(image)
-                stacked_views_sparse[nImg,...] = image
+                np.copyto(self.stacked_views[nImg,...,1].numpy(), self.img_dataset_sparse[curr_img,img_rows,img_cols], casting='unsafe')
 
-        if self.load_sparse:
-            self.stacked_views = torch.cat((self.stacked_views.unsqueeze(-1), stacked_views_sparse.unsqueeze(-1)), dim=3)
+        # DataLoader workers started with spawn/forkserver map tensors in shared memory instead of each receiving a copy of the dataset
+        if share_memory:
+            self.stacked_views.share_memory_()
+            if load_vols:
+                self.vols.share_memory_()
+                if self.quantize_vols:
+                    self.vols_scale.share_memory_()
+                    self.vols_offset.share_memory_()
+
+        # Page-locked storage lets slices be copied to the GPU with non_blocking=True.
+        # The pinned pages can't be swapped out, so don't also raise the DataLoader prefetch_factor blindly.
+        if pin_memory and torch.cuda.is_available():
+            self.stacked_views = self.stacked_views.pin_memory()
+            if load_vols:
+                self.vols = self.vols.pin_memory()
 
         print('Loaded ' + str(self.n_images))  
 
@@ -377,32 +751,57 @@ class XLFMDatasetFullRegistration(data.Dataset):
     def get_max(self):
         'Get max intensity from volumes and images for normalization'
         if self.load_sparse:
-            return  self.stacked_views[...,0].float().max().type(self.stacked_views.type()),\
-                    self.stacked_views[...,1].float().max().type(self.stacked_views.type()),\
-                    self.vols.float().max().type(self.vols.type())
+            return  get_tensor_max(self.stacked_views[...,0]),\
+                    get_tensor_max(self.stacked_views[...,1]),\
+                    get_tensor_max(self.vols, self.vols_scale, self.vols_offset)
         else:
-            return self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.vols.float().max().type(self.vols.type())
+            max_imgs = get_tensor_max(self.stacked_views)
+            return max_imgs, max_imgs.clone(), get_tensor_max(self.vols, self.vols_scale, self.vols_offset)
 
     def get_statistics(self):
         'Get mean and standard deviation from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().mean().type(self.stacked_views.type()), self.stacked_views[...,0].float().std().type(self.stacked_views.type()), \
-                    self.stacked_views[...,1].float().mean().type(self.stacked_views.type()), self.stacked_views[...,1].float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-        else:
-            return  self.stacked_views.float().mean().type(self.stacked_views.type()), self.stacked_views.float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-
-    def standarize(self, stats=None):
+        if self.statistics is None:
+            if self.load_sparse:
+                self.statistics = (*get_tensor_mean_std(self.stacked_views[...,0]), \
+                                *get_tensor_mean_std(self.stacked_views[...,1]), \
+                                *get_tensor_mean_std(self.vols, self.vols_scale, self.vols_offset))
+            else:
+                self.statistics = (*get_tensor_mean_std(self.stacked_views), \
+                                *get_tensor_mean_std(self.vols, self.vols_scale, self.vols_offset))
+        return self.statistics
+
+    def standarize(self, stats=None, in_place=True):
+        if stats is None:
+            stats = self.get_statistics()
+            if not self.load_sparse:
+                # There is no sparse channel to normalize
+                stats = stats[:2] + (0, 1) + stats[2:]
         mean_imgs, std_imgs, mean_imgs_s, std_imgs_s, mean_vols, std_vols = stats
+        # The data changes, the cached statistics are no longer valid
+        self.statistics = None
+        # The reciprocals are computed once in double precision, the passes over the data only multiply
+        inv_std_vols = 1.0/float(std_vols)
+        if self.quantize_vols:
+            # Standardizing the int8 volumes only changes their scale and offset
+            self.vols_offset.sub_(mean_vols).mul_(inv_std_vols)
+            self.vols_scale.mul_(inv_std_vols)
+        if not in_place:
+            # Keep the stored data as is and normalize every sample in __getitem__, skipping the pass over the dataset
+            if self.load_sparse:
+                self.views_normalization = (torch.tensor([float(mean_imgs), float(mean_imgs_s)]), torch.tensor([1.0/float(std_imgs), 1.0/float(std_imgs_s)]))
+            else:
+                self.views_normalization = (torch.tensor(float(mean_imgs)), torch.tensor(1.0/float(std_imgs)))
+            if not self.quantize_vols:
+                self.vols_normalization = (torch.tensor(float(mean_vols)), torch.tensor(inv_std_vols))
+            return
+        # Normalize in place, no temporary copies of the whole dataset
         if self.load_sparse:
-            self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
-            self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
+            self.stacked_views[...,0].sub_(mean_imgs).mul_(1.0/float(std_imgs))
+            self.stacked_views[...,1].sub_(mean_imgs_s).mul_(1.0/float(std_imgs_s))
         else:
-            self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
-        self.vols = (self.vols-mean_vols) / std_vols
+            self.stacked_views.sub_(mean_imgs).mul_(1.0/float(std_imgs))
+        if not self.quantize_vols:
+            self.vols.sub_(mean_vols).mul_(inv_std_vols)
 
     def len_lenslets(self):
         'Denotes the total number of lenslets'
@@ -412,97 +811,143 @@ class XLFMDatasetFullRegistration(data.Dataset):
         return self.lenslet_coords
 
     def pad_img_to_min(self,image):
-        min_size = min(image.shape[-2:])
-        img_pad = [min_size-image.shape[-1], min_size-image.shape[-2]]
-        img_pad = [img_pad[0]//2, img_pad[0]//2, img_pad[1],img_pad[1]]
-        image = F.pad(image.unsqueeze(0).unsqueeze(0), img_pad)[0,0]
-        return image
+        out_shape, src, dst = get_pad_img_to_min_window(image.shape)
+        out = torch.zeros(out_shape, dtype=image.dtype, device=image.device)
+        out[dst] = image[src]
+        return out
+
+    def load_volume(self, nImg, filename):
+        'Reads a single volume from disk and stores it in self.vols[nImg]'
+        self.store_volume(nImg, read_cached_volume(self.read_tiff_stack, filename, self.cache_dir))
+
+    @torch.no_grad()
+    def store_volume(self, nImg, currVol):
+        'Stores a [H,W,depths] volume in self.vols[nImg]'
+        assert not torch.isinf(currVol).any()
+        rows,cols = self.vol_crop
+        currVol = currVol.permute(2,0,1)[:,rows,cols]
+        if self.quantize_vols:
+            # Map the [min(min,0), max(max,0)] range of each depth onto the whole int8 range [-127,127]
+            currVol = currVol.float()
+            lower = currVol.amin(dim=(1,2)).clamp(max=0)
+            scale = ((currVol.amax(dim=(1,2)).clamp(min=0) - lower) / 254).to(self.vol_type)
+            scale[scale==0] = 1
+            # The offset is kept in float32, so zero is exactly representable (code -127) for non negative volumes
+            offset = lower + 127*scale.float()
+            self.vols_scale[nImg,:currVol.shape[0]] = scale
+            self.vols_offset[nImg,:currVol.shape[0]] = offset
+            currVol = ((currVol - offset.unsqueeze(1).unsqueeze(2)) / scale.float().unsqueeze(1).unsqueeze(2)).round_().clamp_(-127,127).to(torch.int8)
+        self.vols[nImg,:currVol.shape[0],:,:] = currVol
+
+    def get_volumes(self, index):
+        'Returns the volumes at index, dequantized if quantize_vols is enabled'
+        if self.vols_scale is not None:
+            return dequantize_volumes(self.vols[index,...], self.vols_scale[index], self.vols_offset[index], self.vol_type)
+        return normalize_sample(self.vols[index,...], self.vols_normalization)
+
+    def get_frame_views(self, indices):
+        'Images of the given frames, normalized if standarize was called with in_place=False'
+        return normalize_sample(self.stacked_views.index_select(0, indices), self.views_normalization)
 
     def __getitem__(self, index):
-        n_frames = self.get_n_temporal_frames()
-        newIndex = index
-        
-        temporal_shifts_ixs = list(range(n_frames))
-        if len(self.temporal_shifts)>0 and not sorted(self.temporal_shifts) == list(range(min(self.temporal_shifts), max(self.temporal_shifts)+1)):
-            temporal_shifts_ixs = self.temporal_shifts
-            newIndex = index
-            if self.use_random_shifts:
-                temporal_shifts_ixs = torch.randint(0, self.n_images-1,[3]).numpy()
-                newIndex = 0
-        img_index = newIndex
-
-        indices = [img_index + temporal_shifts_ixs[i] for i in range(n_frames)]
-        
-        views_out = self.stacked_views[indices,...]
-        if self.load_vols is False:
-            return views_out,0
-        vol_out1 = self.vols[index,...]
-        vol_out2 = self.vols[torch.randint(0,self.__len__()),...]
+        return self.getitem_impl(self, index)
+
+    def get_shifted_frame_indices(self, index):
+        return self.shift_offsets + index
+
+    def get_random_frame_indices(self, index):
+        return torch.randint(0, self.n_images-1,[self.n_frames])
+
+    def get_views(self, index):
+        'Temporal frames of a sample, without volumes'
+        return self.get_frame_views(self.frame_indices_impl(self, index)),0
+
+    def get_views_and_volumes(self, index):
+        views_out = self.get_frame_views(self.frame_indices_impl(self, index))
+        vol_out2 = self.get_volumes(torch.randint(0,self.__len__()))
         
         return views_out,vol_out2
 
     
     def get_voltages_from_volume(self, vol, neuron):
-        index = (self.seg_vol.long() == neuron).nonzero()
+        if self.neuron_indices is None:
+            self.neuron_indices = get_segmentation_indices(self.seg_vol)
+        # Labels are matched as integers, like seg_vol.long() == neuron, tensors and numpy scalars included
+        label = neuron.item() if hasattr(neuron, 'item') else neuron
+        if label == int(label) and int(label) in self.neuron_indices:
+            index = self.neuron_indices[int(label)]
+        else:
+            # Only labels that don't appear in seg_vol select no voxels
+            index = torch.zeros(0, self.seg_vol.ndim, dtype=torch.long)
         
         return vol[index]
 
     @staticmethod
     def extract_views(image, lenslet_coords, subimage_shape, debug=False):
-        half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
-        n_lenslets = lenslet_coords.shape[0]
-        stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+        if image.is_cuda and image.dtype==torch.float32:
+            # Sample all patches in one kernel, half precision grids can't address large images exactly
+            B,C,H,W = image.shape
+            grid = get_lenslet_views_grid(lenslet_coords, subimage_shape, [H,W], image.device)
+            stacked_views = F.grid_sample(image.reshape(B*C,1,H,W), grid.expand(B*C,-1,-1,-1), mode='nearest', padding_mode='zeros', align_corners=True)
+            stacked_views = stacked_views.view(B, C, -1, subimage_shape[0], subimage_shape[1])
+        else:
+            # Grab all patches with a single gather, pixels outside the image are zeroed
+            rows, cols = get_lenslet_views_indices(lenslet_coords, subimage_shape, image.shape[-2:], image.device)
+            stacked_views = gather_lenslet_views(image, rows, cols)
         
         if debug:
             debug_image = image.detach().clone()
             max_img = image.float().cpu().max()
-        for nLens in range(n_lenslets):
-            # Fetch coordinates
-            currCoords = lenslet_coords[nLens,:]
-            if debug:
+            for nLens in range(lenslet_coords.shape[0]):
+                currCoords = lenslet_coords[nLens,:]
                 debug_image[:,:,currCoords[0]-2:currCoords[0]+2,currCoords[1]-2:currCoords[1]+2] = max_img
-            # Grab patches
-            lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
-            lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
-            currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
-            stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
-        
-        if debug:
             import matplotlib.pyplot as plt
             plt.imshow(debug_image[0,0,...].float().cpu().detach().numpy())
             plt.show()
         return stacked_views
         
     @staticmethod
-    def read_tiff_stack(filename, out_datatype=np.float16):
-        try:
-            max_val = np.iinfo(out_datatype).max
-        except:
-            max_val = np.finfo(out_datatype).max
-
-        dataset = Image.open(filename)
-        h,w = np.shape(dataset)
-        tiffarray = np.zeros([h,w,dataset.n_frames], dtype=out_datatype)
-        for i in range(dataset.n_frames):
-            dataset.seek(i)
-            img =  np.array(dataset)
-            img = np.nan_to_num(img)
-            # img[img>=max_val/2] = max_val/2
-            tiffarray[:,:,i] = img.astype(out_datatype)
-        return torch.from_numpy(tiffarray)
-
-    def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2]):
-        for nImg in range(self.stacked_views.shape[0]):
-            signal_power = (signal_power_range[0] + (signal_power_range[1]-signal_power_range[0]) * torch.rand(1)).item()
-            
-            curr_img_stack = self.stacked_views[nImg,...].float()
-            curr_max = curr_img_stack.max()
-            curr_img_stack = signal_power * curr_img_stack / curr_max
-                
-            for kk in range(curr_img_stack.shape[0]):
-                curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
-            curr_img_stack = curr_max * curr_img_stack.float() / signal_power
-            self.stacked_views[nImg,...] = curr_img_stack
+    def read_tiff_stack(filename, out_datatype=np.float16, max_workers=None):
+        if max_workers is None:
+            max_workers = max(1, os.cpu_count()//2)
+        # tifffile decodes the pages in parallel
+        tiffarray = imread(filename, maxworkers=max_workers)
+        if tiffarray.ndim == 2:
+            tiffarray = tiffarray[np.newaxis]
+        tiffarray = np.nan_to_num(tiffarray, copy=False).astype(out_datatype, copy=False)
+        return torch.from_numpy(tiffarray).permute(1,2,0)
+
+    def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2], n_processes=0):
+        n_images = self.stacked_views.shape[0]
+        # One signal power and max per image, broadcasted over the rest of the dimensions
+        per_image_shape = [n_images] + [1]*(self.stacked_views.ndim-1)
+        signal_power = torch.empty(n_images, device=self.stacked_views.device).uniform_(signal_power_range[0], signal_power_range[1]).view(per_image_shape)
+
+        # The camera noise is elementwise, apply it to whole chunks of images at once.
+        # Chunking caps the float32 working set instead of copying the entire dataset
+        if n_processes > 0:
+            # Split in at least one slab per process. The workers noise up to n_processes slabs at a time in a
+            # shared memory buffer that is copied back, the dataset storage itself is left as is (e.g. pinned)
+            chunks = split_in_chunks(self.stacked_views, min(2**26, -(-self.stacked_views.numel()//n_processes)))
+            chunk_powers = signal_power.split(chunks[0].shape[0])
+            slab_size = chunks[0].shape[0]
+            buffer = torch.empty([n_processes*slab_size] + list(self.stacked_views.shape[1:]), dtype=self.stacked_views.dtype).share_memory_()
+            with torch.multiprocessing.Pool(n_processes) as pool:
+                for start in range(0, len(chunks), n_processes):
+                    curr_chunks = chunks[start:start+n_processes]
+                    slabs = [buffer[n*slab_size:n*slab_size+chunk.shape[0]] for n,chunk in enumerate(curr_chunks)]
+                    for slab, chunk in zip(slabs, curr_chunks):
+                        slab.copy_(chunk)
+                    seeds = torch.randint(2**31, [len(curr_chunks)]).tolist()
+                    pool.starmap(add_shot_noise_to_chunk, zip(slabs, chunk_powers[start:start+n_processes], seeds))
+                    for slab, chunk in zip(slabs, curr_chunks):
+                        chunk.copy_(slab)
+            del buffer
+        else:
+            chunks = split_in_chunks(self.stacked_views)
+            for chunk, chunk_power in zip(chunks, signal_power.split(chunks[0].shape[0])):
+                add_shot_noise_to_chunk(chunk, chunk_power)
+        self.statistics = None
         print("Added noise to " + str(self.stacked_views.shape[0]) + " images.")
 
 
@@ -510,7 +955,11 @@ class XLFMDatasetFullRegistration(data.Dataset):
 
 class XLFMDatasetVol(data.Dataset):
     def __init__(self, data_path, lenslet_coords_path, subimage_shape, img_shape, images_to_use=None, lenslets_offset=50, n_depths_to_fill=120, border_blanking=10,
-     load_imgs=False, load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10):
+     load_imgs=False, load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10, pin_memory=False, memory_format=torch.contiguous_format,
+     quantize_vols=False, use_processes=False, share_memory=False, cache_dir=None):
+        if share_memory and pin_memory:
+            # pin_memory() copies the tensors out of shared memory, one flag would silently undo the other
+            raise ValueError('share_memory and pin_memory can not be used together')
         # Load lenslets coordinates
         self.lenslet_coords = get_lenslet_centers(lenslet_coords_path) + torch.tensor(lenslets_offset)
         self.n_lenslets = self.lenslet_coords.shape[0]
@@ -520,11 +969,38 @@ class XLFMDatasetVol(data.Dataset):
         self.load_sparse = load_sparse
         self.temporal_shifts = temporal_shifts
         self.use_random_shifts = use_random_shifts
+        # Frame offsets added to the sample index in __getitem__, only non contiguous shifts are used as given
+        self.n_frames = len(temporal_shifts)
+        self.shift_offsets = torch.arange(self.n_frames)
+        self.random_shifts = False
+        if len(temporal_shifts)>0 and not sorted(temporal_shifts) == list(range(min(temporal_shifts), max(temporal_shifts)+1)):
+            self.shift_offsets = torch.tensor(temporal_shifts, dtype=torch.long)
+            self.random_shifts = use_random_shifts
+        # The sample layout is fixed, pick the __getitem__ implementation once.
+        # Unbound functions are stored, bound methods would make the dataset reference itself
+        cls = type(self)
+        self.frame_indices_impl = cls.get_random_frame_indices if self.random_shifts else cls.get_shifted_frame_indices
+        self.getitem_impl = {(True,True): cls.get_views_and_volumes, (True,False): cls.get_views,
+                            (False,True): cls.get_frame_volumes, (False,False): cls.get_empty_sample}[(load_imgs,load_vols)]
         self.vol_type = torch.float16
+        self.quantize_vols = quantize_vols and load_vols
+        self.vols_scale, self.vols_offset = None, None
+        # Decoded volumes are cached as .npy files in cache_dir
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # Normalization statistics, computed on the first get_statistics call
+        self.statistics = None
+        # Voxel coordinates of each neuron of seg_vol, built on the first get_voltages_from_volume call
+        self.neuron_indices = None
+        # Mean and inverse std applied to each sample when it's fetched, set by standarize(in_place=False)
+        self.views_normalization, self.vols_normalization = None, None
 
         self.img_shape = img_shape
         self.subimage_shape = subimage_shape
         self.half_subimg_shape = [self.subimage_shape[0]//2,self.subimage_shape[1]//2]
+        # Build the extract_views indices once, the views are extracted from images of img_shape
+        get_lenslet_views_indices(self.lenslet_coords, self.subimage_shape, self.img_shape)
 
         # Tiff images are stored in single tiff stack
         # Volumes are stored in individual tiff stacks
@@ -534,11 +1010,11 @@ class XLFMDatasetVol(data.Dataset):
 
         # dataset = Image.open(imgs_path)
         if load_imgs:
-            self.img_dataset = imread(imgs_path, maxworkers=maxWorkers)
+            self.img_dataset = read_image_stack(imgs_path, maxWorkers)
             n_frames,h,w = np.shape(self.img_dataset)
             if self.load_sparse:
                 try:
-                    self.img_dataset_sparse = imread(imgs_path_sparse, maxworkers=maxWorkers)
+                    self.img_dataset_sparse = read_image_stack(imgs_path_sparse, maxWorkers)
                 except:
                     self.load_sparse = False
                     print('Dataset error: Sparse dir XLFM_image/XLFM_image_stack_S.tif not found')
@@ -553,13 +1029,14 @@ class XLFMDatasetVol(data.Dataset):
 
         self.all_files = sorted(glob.glob(vols_path))
         if len(self.all_files)>0 and load_vols:
-            self.all_files = [sorted(glob.glob(vols_path))[images_to_use[i]] for i in range(self.n_images)]
+            self.all_files = [self.all_files[images_to_use[i]] for i in range(self.n_images)]
 
         if self.load_sparse:
             vols_path_sparse = data_path + '/XLFM_stack_S/*.tif'
         if load_vols:
             if self.load_sparse:
-                self.all_files= [sorted(glob.glob(vols_path_sparse))[images_to_use[i]] for i in range(self.n_images)]
+                all_files_sparse = sorted(glob.glob(vols_path_sparse))
+                self.all_files= [all_files_sparse[images_to_use[i]] for i in range(self.n_images)]
             # read single volume
             currVol = self.read_tiff_stack(self.all_files[0])
             odd_size = [currVol.shape[0], currVol.shape[1]]
@@ -568,49 +1045,79 @@ class XLFMDatasetVol(data.Dataset):
             half_volume_shape = [odd_size[0]//2,odd_size[1]//2]
             self.volStart = [currVol.shape[0]//2-half_volume_shape[0], currVol.shape[1]//2-half_volume_shape[1]]
             self.volEnd = [odd_size[n] + self.volStart[n] for n in range(len(self.volStart))]
-            self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
+            self.vol_crop = (slice(self.volStart[0],self.volEnd[0]), slice(self.volStart[1],self.volEnd[1]))
+            n_vol_depths = currVol.shape[2]
+            # Depths are the channels of the networks, torch.channels_last stores them innermost
+            self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=torch.int8 if self.quantize_vols else self.vol_type)\
+                .contiguous(memory_format=memory_format)
+            if self.quantize_vols:
+                # Volumes are stored as int8 with a per depth scale and offset
+                self.vols_scale = torch.ones(self.n_images, n_depths_to_fill, dtype=self.vol_type)
+                self.vols_offset = torch.zeros(self.n_images, n_depths_to_fill, dtype=torch.float32)
             
         else:
             odd_size = self.subimage_shape
             self.vols = 255*torch.ones(1)
         
         if load_imgs:
-            # Create image storage
-            self.stacked_views = torch.zeros(self.n_images, self.img_shape[0], self.img_shape[1],dtype=torch.float16)
+            # Create image storage, sparse images are stored along the last dimension
+            self.stacked_views = torch.zeros([self.n_images, self.img_shape[0], self.img_shape[1]] + ([2] if self.load_sparse else []), dtype=torch.float16)
+            dense_views = self.stacked_views[...,0] if self.load_sparse else self.stacked_views
+            img_rows,img_cols = get_image_crop(self.img_dataset.shape, self.img_shape)
         else:
             self.stacked_views = torch.ones([1])
-        if self.load_sparse:
-            stacked_views_sparse = self.stacked_views.clone()
+
+        if load_vols:
+            vol_files = [self.all_files[images_to_use[nImg]] for nImg in range(self.n_images)]
+            if use_processes:
+                # Decode in worker processes, for tiff decoders that hold the GIL
+                with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+                    for nImg,currVol in enumerate(tqdm(executor.map(partial(read_volume_array, self.read_tiff_stack, self.cache_dir), vol_files),
+                        total=self.n_images, desc="Loading Vol...")):
+                        self.store_volume(nImg, torch.from_numpy(currVol))
+            else:
+                # Volumes are decoded in parallel, the tiff decoder releases the GIL
+                with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                    list(tqdm(executor.map(self.load_volume, range(self.n_images), vol_files), total=self.n_images, desc="Loading Vol..."))
+            # Blank the borders of all volumes at once
+            if border_blanking>0:
+                # Value of a zero voxel, quantized volumes encode it with a per depth code
+                blank = torch.zeros(1, self.vols.shape[1], 1, 1, dtype=self.vols.dtype)
+                if self.quantize_vols:
+                    blank = (-self.vols_offset / self.vols_scale.float()).round_().clamp_(-127,127).to(torch.int8).unsqueeze(-1).unsqueeze(-1)
+                self.vols[:,:border_blanking,...] = blank[:,:border_blanking]
+                self.vols[:,max(n_vol_depths-border_blanking,0):n_vol_depths,...] = blank[:,max(n_vol_depths-border_blanking,0):n_vol_depths]
+                self.vols[:,:,:border_blanking,:] = blank
+                self.vols[:,:,-border_blanking:,:] = blank
+                self.vols[:,:,:,:border_blanking] = blank
+                self.vols[:,:,:,-border_blanking:] = blank
 
         for nImg in tqdm (range(self.n_images), desc="Loading Img..."):
             # Load the images indicated from the user
             curr_img = images_to_use[nImg]
 
-            if load_vols:
-                currVol = self.read_tiff_stack(self.all_files[curr_img])
-                assert not torch.isinf(currVol).any()
-                if border_blanking>0:
-                    currVol[:border_blanking,...] = 0
-                    currVol[-border_blanking:,...] = 0
-                    currVol[:,:border_blanking,...] = 0
-                    currVol[:,-border_blanking:,...] = 0
-                    currVol[:,:,:border_blanking] = 0
-                    currVol[:,:,-border_blanking:] = 0
-                self.vols[nImg,:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
-                    [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
-
             if load_imgs:
-                image = torch.from_numpy(np.array(self.img_dataset[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-                image = self.pad_img_to_min(image)
-                self.stacked_views[nImg,...] = center_crop(image.unsqueeze(0).unsqueeze(0), self.img_shape)[0,0,...]
+                # Crop and cast straight into the image storage, numpy() shares its memory
+                np.copyto(dense_views[nImg,...].numpy(), self.img_dataset[curr_img,img_rows,img_cols], casting='unsafe')
                 
                 if self.load_sparse:
-                    image = torch.from_numpy(np.array(self.img_dataset_sparse[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-                    image = self.pad_img_to_min(image)
-                    stacked_views_sparse[nImg,...] = image
+                    np.copyto(self.stacked_views[nImg,...,1].numpy(), self.img_dataset_sparse[curr_img,img_rows,img_cols], casting='unsafe')
 
-        if load_imgs and self.load_sparse:
-            self.stacked_views = torch.cat((self.stacked_views.unsqueeze(-1), stacked_views_sparse.unsqueeze(-1)), dim=3)
+        # DataLoader workers started with spawn/forkserver map tensors in shared memory instead of each receiving a copy of the dataset
+        if share_memory:
+            self.stacked_views.share_memory_()
+            if load_vols:
+                self.vols.share_memory_()
+                if self.quantize_vols:
+                    self.vols_scale.share_memory_()
+                    self.vols_offset.share_memory_()
+
+        # Page-locked storage lets slices be copied to the GPU with non_blocking=True.
+        # The pinned pages can't be swapped out, so don't also raise the DataLoader prefetch_factor blindly.
+        if pin_memory and torch.cuda.is_available():
+            self.stacked_views = self.stacked_views.pin_memory()
+            if load_vols:
+                self.vols = self.vols.pin_memory()
 
         print('Loaded ' + str(self.n_images))  
 
@@ -629,32 +1136,57 @@ class XLFMDatasetVol(data.Dataset):
     def get_max(self):
         'Get max intensity from volumes and images for normalization'
         if self.load_sparse:
-            return  self.stacked_views[...,0].float().max().type(self.stacked_views.type()),\
-                    self.stacked_views[...,1].float().max().type(self.stacked_views.type()),\
-                    self.vols.float().max().type(self.vols.type())
+            return  get_tensor_max(self.stacked_views[...,0]),\
+                    get_tensor_max(self.stacked_views[...,1]),\
+                    get_tensor_max(self.vols, self.vols_scale, self.vols_offset)
         else:
-            return self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.vols.float().max().type(self.vols.type())
+            max_imgs = get_tensor_max(self.stacked_views)
+            return max_imgs, max_imgs.clone(), get_tensor_max(self.vols, self.vols_scale, self.vols_offset)
 
     def get_statistics(self):
         'Get mean and standard deviation from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().mean().type(self.stacked_views.type()), self.stacked_views[...,0].float().std().type(self.stacked_views.type()), \
-                    self.stacked_views[...,1].float().mean().type(self.stacked_views.type()), self.stacked_views[...,1].float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-        else:
-            return  self.stacked_views.float().mean().type(self.stacked_views.type()), self.stacked_views.float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-
-    def standarize(self, stats=None):
+        if self.statistics is None:
+            if self.load_sparse:
+                self.statistics = (*get_tensor_mean_std(self.stacked_views[...,0]), \
+                                *get_tensor_mean_std(self.stacked_views[...,1]), \
+                                *get_tensor_mean_std(self.vols, self.vols_scale, self.vols_offset))
+            else:
+                self.statistics = (*get_tensor_mean_std(self.stacked_views), \
+                                *get_tensor_mean_std(self.vols, self.vols_scale, self.vols_offset))
+        return self.statistics
+
+    def standarize(self, stats=None, in_place=True):
+        if stats is None:
+            stats = self.get_statistics()
+            if not self.load_sparse:
+                # There is no sparse channel to normalize
+                stats = stats[:2] + (0, 1) + stats[2:]
         mean_imgs, std_imgs, mean_imgs_s, std_imgs_s, mean_vols, std_vols = stats
+        # The data changes, the cached statistics are no longer valid
+        self.statistics = None
+        # The reciprocals are computed once in double precision, the passes over the data only multiply
+        inv_std_vols = 1.0/float(std_vols)
+        if self.quantize_vols:
+            # Standardizing the int8 volumes only changes their scale and offset
+            self.vols_offset.sub_(mean_vols).mul_(inv_std_vols)
+            self.vols_scale.mul_(inv_std_vols)
+        if not in_place:
+            # Keep the stored data as is and normalize every sample in __getitem__, skipping the pass over the dataset
+            if self.load_sparse:
+                self.views_normalization = (torch.tensor([float(mean_imgs), float(mean_imgs_s)]), torch.tensor([1.0/float(std_imgs), 1.0/float(std_imgs_s)]))
+            else:
+                self.views_normalization = (torch.tensor(float(mean_imgs)), torch.tensor(1.0/float(std_imgs)))
+            if not self.quantize_vols:
+                self.vols_normalization = (torch.tensor(float(mean_vols)), torch.tensor(inv_std_vols))
+            return
+        # Normalize in place, no temporary copies of the whole dataset
         if self.load_sparse:
-            self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
-            self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
+            self.stacked_views[...,0].sub_(mean_imgs).mul_(1.0/float(std_imgs))
+            self.stacked_views[...,1].sub_(mean_imgs_s).mul_(1.0/float(std_imgs_s))
         else:
-            self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
-        self.vols = (self.vols-mean_vols) / std_vols
+            self.stacked_views.sub_(mean_imgs).mul_(1.0/float(std_imgs))
+        if not self.quantize_vols:
+            self.vols.sub_(mean_vols).mul_(inv_std_vols)
 
     def len_lenslets(self):
         'Denotes the total number of lenslets'
@@ -664,92 +1196,152 @@ class XLFMDatasetVol(data.Dataset):
         return self.lenslet_coords
 
     def pad_img_to_min(self,image):
-        min_size = min(image.shape[-2:])
-        img_pad = [min_size-image.shape[-1], min_size-image.shape[-2]]
-        img_pad = [img_pad[0]//2, img_pad[0]//2, img_pad[1],img_pad[1]]
-        image = F.pad(image.unsqueeze(0).unsqueeze(0), img_pad)[0,0]
-        return image
+        out_shape, src, dst = get_pad_img_to_min_window(image.shape)
+        out = torch.zeros(out_shape, dtype=image.dtype, device=image.device)
+        out[dst] = image[src]
+        return out
+
+    def load_volume(self, nImg, filename):
+        'Reads a single volume from disk and stores it in self.vols[nImg]'
+        self.store_volume(nImg, read_cached_volume(self.read_tiff_stack, filename, self.cache_dir))
+
+    @torch.no_grad()
+    def store_volume(self, nImg, currVol):
+        'Stores a [H,W,depths] volume in self.vols[nImg]'
+        assert not torch.isinf(currVol).any()
+        rows,cols = self.vol_crop
+        currVol = currVol.permute(2,0,1)[:,rows,cols]
+        if self.quantize_vols:
+            # Map the [min(min,0), max(max,0)] range of each depth onto the whole int8 range [-127,127]
+            currVol = currVol.float()
+            lower = currVol.amin(dim=(1,2)).clamp(max=0)
+            scale = ((currVol.amax(dim=(1,2)).clamp(min=0) - lower) / 254).to(self.vol_type)
+            scale[scale==0] = 1
+            # The offset is kept in float32, so zero is exactly representable (code -127) for non negative volumes
+            offset = lower + 127*scale.float()
+            self.vols_scale[nImg,:currVol.shape[0]] = scale
+            self.vols_offset[nImg,:currVol.shape[0]] = offset
+            currVol = ((currVol - offset.unsqueeze(1).unsqueeze(2)) / scale.float().unsqueeze(1).unsqueeze(2)).round_().clamp_(-127,127).to(torch.int8)
+        self.vols[nImg,:currVol.shape[0],:,:] = currVol
+
+    def get_volumes(self, index):
+        'Returns the volumes at index, dequantized if quantize_vols is enabled'
+        if self.vols_scale is not None:
+            return dequantize_volumes(self.vols[index,...], self.vols_scale[index], self.vols_offset[index], self.vol_type)
+        return normalize_sample(self.vols[index,...], self.vols_normalization)
+
+    def get_frame_views(self, indices):
+        'Images of the given frames, normalized if standarize was called with in_place=False'
+        return normalize_sample(self.stacked_views.index_select(0, indices), self.views_normalization)
 
     def __getitem__(self, index):
-        n_frames = self.get_n_temporal_frames()
-        newIndex = index
-        
-        temporal_shifts_ixs = list(range(n_frames))
-        if len(self.temporal_shifts)>0 and not sorted(self.temporal_shifts) == list(range(min(self.temporal_shifts), max(self.temporal_shifts)+1)):
-            temporal_shifts_ixs = self.temporal_shifts
-            newIndex = index
-            if self.use_random_shifts:
-                temporal_shifts_ixs = torch.randint(0, self.n_images-1,[3]).numpy()
-                newIndex = 0
-        img_index = newIndex
-
-        indices = [img_index + temporal_shifts_ixs[i] for i in range(n_frames)]
-        
-        if self.load_imgs:
-            views_out = self.stacked_views[indices,...]
-        else:
-            views_out = 0
-        if self.load_vols:
-            vol_out = self.vols[indices,...]
-        else:
-            vol_out = 0
+        return self.getitem_impl(self, index)
+
+    def get_shifted_frame_indices(self, index):
+        return self.shift_offsets + index
+
+    def get_random_frame_indices(self, index):
+        return torch.randint(0, self.n_images-1,[self.n_frames])
 
-        return views_out,vol_out
+    def get_views(self, index):
+        'Temporal frames of a sample, without volumes'
+        return self.get_frame_views(self.frame_indices_impl(self, index)),0
+
+    def get_frame_volumes(self, index):
+        'Volumes of the temporal frames of a sample, without images'
+        return 0,self.get_volumes(self.frame_indices_impl(self, index))
+
+    def get_views_and_volumes(self, index):
+        indices = self.frame_indices_impl(self, index)
+        return self.get_frame_views(indices),self.get_volumes(indices)
+
+    def get_empty_sample(self, index):
+        return 0,0
 
     
     def get_voltages_from_volume(self, vol, neuron):
-        index = (self.seg_vol.long() == neuron).nonzero()
+        if self.neuron_indices is None:
+            self.neuron_indices = get_segmentation_indices(self.seg_vol)
+        # Labels are matched as integers, like seg_vol.long() == neuron, tensors and numpy scalars included
+        label = neuron.item() if hasattr(neuron, 'item') else neuron
+        if label == int(label) and int(label) in self.neuron_indices:
+            index = self.neuron_indices[int(label)]
+        else:
+            # Only labels that don't appear in seg_vol select no voxels
+            index = torch.zeros(0, self.seg_vol.ndim, dtype=torch.long)
         
         return vol[index]
 
     @staticmethod
     def extract_views(image, lenslet_coords, subimage_shape, debug=False):
-        half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
-        n_lenslets = lenslet_coords.shape[0]
-        stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+        if image.is_cuda and image.dtype==torch.float32:
+            # Sample all patches in one kernel, half precision grids can't address large images exactly
+            B,C,H,W = image.shape
+            grid = get_lenslet_views_grid(lenslet_coords, subimage_shape, [H,W], image.device)
+            stacked_views = F.grid_sample(image.reshape(B*C,1,H,W), grid.expand(B*C,-1,-1,-1), mode='nearest', padding_mode='zeros', align_corners=True)
+            stacked_views = stacked_views.view(B, C, -1, subimage_shape[0], subimage_shape[1])
+        else:
+            # Grab all patches with a single gather, pixels outside the image are zeroed
+            rows, cols = get_lenslet_views_indices(lenslet_coords, subimage_shape, image.shape[-2:], image.device)
+            stacked_views = gather_lenslet_views(image, rows, cols)
         
         if debug:
             debug_image = image.detach().clone()
             max_img = image.float().cpu().max()
-        for nLens in range(n_lenslets):
-            # Fetch coordinates
-            currCoords = lenslet_coords[nLens,:]
-            if debug:
+            for nLens in range(lenslet_coords.shape[0]):
+                currCoords = lenslet_coords[nLens,:]
                 debug_image[:,:,currCoords[0]-2:currCoords[0]+2,currCoords[1]-2:currCoords[1]+2] = max_img
-            # Grab patches
-            lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
-            lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
-            currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
-            stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
-        
-        if debug:
             import matplotlib.pyplot as plt
             plt.imshow(debug_image[0,0,...].float().cpu().detach().numpy())
             plt.show()
         return stacked_views
         
     @staticmethod
-    def read_tiff_stack(filename, out_datatype=torch.float16):
-        tiffarray = mtif.read_stack(filename, units='voxels')
-        try:
-            max_val = torch.iinfo(out_datatype).max
-        except:
-            max_val = torch.finfo(out_datatype).max
-        out = np.clip(tiffarray.raw_images, 0, max_val)
-        return torch.from_numpy(out).permute(1,2,0).type(out_datatype)
-
-    def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2]):
-        for nImg in range(self.stacked_views.shape[0]):
-            signal_power = (signal_power_range[0] + (signal_power_range[1]-signal_power_range[0]) * torch.rand(1)).item()
-            
-            curr_img_stack = self.stacked_views[nImg,...].float()
-            curr_max = curr_img_stack.max()
-            curr_img_stack = signal_power * curr_img_stack / curr_max
-                
-            for kk in range(curr_img_stack.shape[0]):
-                curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
-            curr_img_stack = curr_max * curr_img_stack.float() / signal_power
-            self.stacked_views[nImg,...] = curr_img_stack
+    def read_tiff_stack(filename, out_datatype=torch.float16, max_workers=None):
+        if max_workers is None:
+            max_workers = max(1, os.cpu_count()//2)
+        # tifffile decodes the pages in parallel
+        tiffarray = imread(filename, maxworkers=max_workers)
+        if tiffarray.ndim == 2:
+            tiffarray = tiffarray[np.newaxis]
+        np_datatype = np.dtype(torch_to_numpy_datatypes.get(out_datatype, out_datatype))
+        max_val = datatype_max_values[np_datatype]
+        # Clip straight into an array of the output type, torch.from_numpy then shares its memory
+        out = tiffarray if tiffarray.dtype==np_datatype else np.empty_like(tiffarray, dtype=np_datatype)
+        np.clip(tiffarray, 0, max_val, out=out, casting='unsafe')
+        return torch.from_numpy(out).permute(1,2,0)
+
+    def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2], n_processes=0):
+        n_images = self.stacked_views.shape[0]
+        # One signal power and max per image, broadcasted over the rest of the dimensions
+        per_image_shape = [n_images] + [1]*(self.stacked_views.ndim-1)
+        signal_power = torch.empty(n_images, device=self.stacked_views.device).uniform_(signal_power_range[0], signal_power_range[1]).view(per_image_shape)
+
+        # The camera noise is elementwise, apply it to whole chunks of images at once.
+        # Chunking caps the float32 working set instead of copying the entire dataset
+        if n_processes > 0:
+            # Split in at least one slab per process. The workers noise up to n_processes slabs at a time in a
+            # shared memory buffer that is copied back, the dataset storage itself is left as is (e.g. pinned)
+            chunks = split_in_chunks(self.stacked_views, min(2**26, -(-self.stacked_views.numel()//n_processes)))
+            chunk_powers = signal_power.split(chunks[0].shape[0])
+            slab_size = chunks[0].shape[0]
+            buffer = torch.empty([n_processes*slab_size] + list(self.stacked_views.shape[1:]), dtype=self.stacked_views.dtype).share_memory_()
+            with torch.multiprocessing.Pool(n_processes) as pool:
+                for start in range(0, len(chunks), n_processes):
+                    curr_chunks = chunks[start:start+n_processes]
+                    slabs = [buffer[n*slab_size:n*slab_size+chunk.shape[0]] for n,chunk in enumerate(curr_chunks)]
+                    for slab, chunk in zip(slabs, curr_chunks):
+                        slab.copy_(chunk)
+                    seeds = torch.randint(2**31, [len(curr_chunks)]).tolist()
+                    pool.starmap(add_shot_noise_to_chunk, zip(slabs, chunk_powers[start:start+n_processes], seeds))
+                    for slab, chunk in zip(slabs, curr_chunks):
+                        chunk.copy_(slab)
+            del buffer
+        else:
+            chunks = split_in_chunks(self.stacked_views)
+            for chunk, chunk_power in zip(chunks, signal_power.split(chunks[0].shape[0])):
+                add_shot_noise_to_chunk(chunk, chunk_power)
+        self.statistics = None
         print("Added noise to " + str(self.stacked_views.shape[0]) + " images.")
 
 
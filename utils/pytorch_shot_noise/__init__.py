@@ -1,6 +1,5 @@
 import torch
 import numpy as np
-import torch.distributions as tdist
 
 # Function to add camera noise
 # http://kmdouglass.github.io/posts/modeling-noise-for-image-simulations/
@@ -9,27 +8,23 @@ def add_camera_noise(input_irrad_gray, qe=0.82, sensitivity=5.88,
     
     # input_irrad_gray = input_irrad_gray.float()
     # Convert gray to photons
-    input_irrad_electrons = input_irrad_gray / sensitivity #* full_well / (2**bitdepth-1)
-    input_irrad_electrons[input_irrad_electrons<0] = 0.0
+    input_irrad_electrons = (input_irrad_gray / sensitivity).clamp_(min=0) #* full_well / (2**bitdepth-1)
     input_irrad_photons = input_irrad_electrons / qe
 
     # Add shot noise
-    distribution_poiss = torch.distributions.poisson.Poisson(input_irrad_photons+1e-5)
-    distribution_norm = torch.distributions.normal.Normal(torch.zeros_like(input_irrad_photons), dark_noise)
-    photons = distribution_poiss.sample()
+    photons = torch.poisson(input_irrad_photons+1e-5)
     
     # Convert to electrons
     electrons = qe * photons
     
     # Add dark noise
-    electrons_out = electrons + distribution_norm.sample()
+    electrons_out = electrons + dark_noise * torch.randn_like(electrons)
     
     # Convert to ADU and add baseline
-    max_adu     = np.int(2**bitdepth - 1)
+    max_adu     = int(2**bitdepth - 1)
     adu         = (electrons_out * sensitivity).int() # Convert to discrete numbers
     adu += baseline
-    adu[adu > max_adu] = max_adu # models pixel saturation
-    adu[adu < 0] = 0
+    adu.clamp_(0, max_adu) # models pixel saturation
     return adu
 
 